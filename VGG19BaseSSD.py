@@ -7,7 +7,8 @@ from box_utils import BoxUtils
 
 class Vgg19BaseSSD(nn.Module):
 
-    def __init__(self,  width, height, n_classes, scales, aspect_ratios):
+    def __init__(self,  width, height, n_classes, scales, aspect_ratios, pretrained=True):
+        #pretrained: initialize the base with ImageNet weights, not needed when a checkpoint is loaded afterwards
         super(Vgg19BaseSSD, self).__init__()
         n_classes   = n_classes + 1
         self.scales = scales
@@ -18,7 +19,7 @@ class Vgg19BaseSSD(nn.Module):
         self.height = height
         self.class_logsoftmax = nn.LogSoftmax(dim=2)
 
-        vgg19 = torchvision.models.vgg19(pretrained=True)
+        vgg19 = torchvision.models.vgg19(pretrained=pretrained)
         self.vgg19_base = vgg19.features
         self.predict_layers_indices = [20, 25, 34]
         self.in_channels            = [512, 512, 512]
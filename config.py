@@ -1,3 +1,4 @@
+import os
 
 
 class TrainConfig:
@@ -6,11 +7,15 @@ class TrainConfig:
     eval_file_path  = 'data/ssd_eval.pkl'
     data_dir        = 'data/images'
     batch_size      = 16
+    accum_steps     = 1 #Micro batches per optimizer step, effective batch size is batch_size * accum_steps
+    num_workers     = max(1, (os.cpu_count() or 2) // 2)
     neg_pos_ratio   = 3
     alpha           = 1
     num_epochs      = 60
     checkpoint_dir  = 'checkpoints'
     checkpoint_file = 'ssd_1_6.4616_5.9102.pth'
+    keep_checkpoints = 5
+    compile_model   = True
     
     
 class EvalConfig:
@@ -18,6 +23,7 @@ class EvalConfig:
     eval_file_path  = 'data/ssd_eval.pkl'
     data_dir        = 'data/images'
     batch_size      = 1
+    num_workers     = max(1, (os.cpu_count() or 2) // 2)
     checkpoint_dir  = 'checkpoints'
     checkpoint_file = 'ssd_57_0.4850_0.6215.pth'
     groundtruths    = 'eval/groundtruths'
@@ -3,6 +3,7 @@ import numpy as np
 import pandas as pd
 import cv2
 import os
+from torchvision.transforms import v2
 from imgaug import augmenters as iaa
 from imgaug.augmentables.bbs import BoundingBoxesOnImage
 
@@ -21,7 +22,7 @@ class SSDDataset(torch.utils.data.Dataset):
     def __getitem__(self, idx):
         filename = self.df.iloc[idx, 0]
         objs     = self.df.iloc[idx, 1]
-        objs     = np.asarray(objs, dtype=np.float)
+        objs     = np.asarray(objs, dtype=np.float64)
         full_path = os.path.join(self.root, filename)
         image    = cv2.imread(full_path)
         sample   = {'image': image, 'objs': objs, 'filename': filename}
@@ -51,7 +52,7 @@ class Normalization(object):
     
     def __call__(self, sample):
         image, objs, filename = sample['image'], sample['objs'], sample['filename']
-        image = image.astype(np.float)
+        image = image.astype(np.float64)
         image = (image - self.mean) / self.std
         return {'image': image, 'objs': objs, 'filename': filename}
     
@@ -65,7 +66,7 @@ class Normalization2(object):
     
     def __call__(self, sample):
         image, objs, filename = sample['image'], sample['objs'], sample['filename']
-        image = image.astype(np.float)
+        image = image.astype(np.float64)
         image = image / 255.0
         return {'image': image, 'objs': objs, 'filename': filename}
     
@@ -81,14 +82,20 @@ class SSDDataAugmentation(object):
                  random_translate={'low': -0.2, 'high': 0.2},
                  random_scale={'min': 0.7, 'max': 1.2},
                  prob=0.8,
-                 train=True):
+                 train=True,
+                 photometric=True):
+        #photometric: apply the color augmentations here, set to False when they run on the device
+        #             with SSDPhotometricAugmentation instead
         self.train = train
         if self.train:
-            self.seq_train = iaa.Sequential([iaa.Sometimes(random_brightness['prob'], iaa.Add((random_brightness['low'], random_brightness['high']))),
-                                    iaa.Sometimes(random_contrast['prob'], iaa.LinearContrast((random_contrast['low'], random_contrast['high']))),
-                                    iaa.Sometimes(random_saturation['prob'], iaa.MultiplySaturation((random_saturation['low'], random_saturation['high']))),
-                                    iaa.Sometimes(random_hue['prob'], iaa.MultiplyHue((random_hue['low'], random_hue['high']))),
-                                    iaa.ChannelShuffle(channel_shuffle['prob']),
+            color_aug = []
+            if photometric:
+                color_aug = [iaa.Sometimes(random_brightness['prob'], iaa.Add((random_brightness['low'], random_brightness['high']))),
+                             iaa.Sometimes(random_contrast['prob'], iaa.LinearContrast((random_contrast['low'], random_contrast['high']))),
+                             iaa.Sometimes(random_saturation['prob'], iaa.MultiplySaturation((random_saturation['low'], random_saturation['high']))),
+                             iaa.Sometimes(random_hue['prob'], iaa.MultiplyHue((random_hue['low'], random_hue['high']))),
+                             iaa.ChannelShuffle(channel_shuffle['prob'])]
+            self.seq_train = iaa.Sequential(color_aug + [
                                     iaa.Sometimes(0.5, iaa.Affine(translate_percent={'x': (random_translate['low'], random_translate['high']), 
                                                                     'y': (random_translate['low'], random_translate['high'])},
                                                 scale={'x': (random_scale['min'], random_scale['max']),
@@ -111,16 +118,88 @@ class SSDDataAugmentation(object):
         return {'image': image, 'objs': objs, 'filename': filename}
 
 
+class SSDPhotometricAugmentation(object):
+    """Color augmentations on a batch of uint8 images, runs on the device of the batch."""
+
+    def __init__(self, random_brightness={'low': 0.8, 'high': 1.2},
+                 random_contrast={'low': 0.5, 'high': 1.5},
+                 random_saturation={'low': 0.5, 'high': 1.5},
+                 random_hue={'low': -0.05, 'high': 0.05},
+                 prob=0.5):
+        #Each color op and the channel shuffle are applied independently with probability prob
+        self.distort = v2.RandomPhotometricDistort(brightness=(random_brightness['low'], random_brightness['high']),
+                                                   contrast=(random_contrast['low'], random_contrast['high']),
+                                                   saturation=(random_saturation['low'], random_saturation['high']),
+                                                   hue=(random_hue['low'], random_hue['high']),
+                                                   p=prob)
+
+    def __call__(self, images):
+        #images: uint8 tensor (batch, h, w, c)
+        #return: uint8 tensor (batch, h, w, c), every image gets its own random parameters
+        #One call on the whole batch would launch fewer kernels, but v2 samples a single set of parameters per call,
+        #so every image of the batch would get the same colors, which is weaker than the per sample imgaug pipeline
+        return torch.stack([self.distort(image.permute(2, 0, 1)).permute(1, 2, 0) for image in images])
+
+
 
 def collate_sample(list_samples):
     #list_samples: list of dictionary {'image': image, 'objs': objs}
-    #return: dictionary {'image': np.asarray(list all images), 'objs': list of all objs}
-    image_batched = np.asarray([sample['image'] for sample in list_samples])
+    #return: dictionary {'image': uint8 tensor (batch, h, w, c) of all images, 'objs': list of all objs}
+    image_batched = np.asarray([sample['image'] for sample in list_samples], dtype=np.uint8)
     objs_batched  = [sample['objs'] for sample in list_samples]
     filename_batched = [sample['filename'] for sample in list_samples]
-    return {'image': torch.as_tensor(image_batched, dtype=torch.float),
+    return {'image': torch.from_numpy(image_batched),
             'objs': objs_batched,
             'filename': filename_batched}
+
+
+class CUDAPrefetcher(object):
+    """Copy the images of the next batch to the device on a side stream while the current batch is used."""
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream() if device == 'cuda' else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def preload(self, loader_iter):
+        batch = next(loader_iter, None)
+        if batch is None:
+            return None
+        if self.stream is None:
+            batch['image'] = batch['image'].to(self.device)
+        else:
+            with torch.cuda.stream(self.stream):
+                batch['image'] = batch['image'].to(self.device, non_blocking=True)
+        return batch
+
+    def __iter__(self):
+        loader_iter = iter(self.loader)
+        batch = self.preload(loader_iter)
+        while batch is not None:
+            if self.stream is not None:
+                #Wait for the copy of this batch only, then mark its memory as used by the compute stream
+                torch.cuda.current_stream().wait_stream(self.stream)
+                batch['image'].record_stream(torch.cuda.current_stream())
+            #Start copying the next batch before the current one is consumed
+            next_batch = self.preload(loader_iter)
+            yield batch
+            batch = next_batch
+
+
+def worker_init_fn(worker_id):
+    #Augmentation runs in OpenCV (through imgaug), one thread per loader worker avoids oversubscribing the cpu cores
+    cv2.setNumThreads(1)
+
+
+def normalize_batch(images):
+    #Same as Transpose + Normalization2, done on the device the images were copied to
+    #images: uint8 tensor (batch, h, w, c)
+    #return: float tensor (batch, c, h, w) rescaled to [0, 1], in channels_last memory format
+    #The permuted (h, w, c) batch is already laid out as channels_last, so this is a single dtype conversion
+    return images.permute(0, 3, 1, 2).to(torch.float32, memory_format=torch.channels_last).div_(255.0)
     
     
     
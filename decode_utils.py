@@ -1,5 +1,4 @@
-import numpy as np
-from box_utils import BoxUtils
+import torch
 import torchvision
 
 def decode_output_decoder(output, traced, nms, conf_thresh=0.5, iou_thresh=0.01):
@@ -31,61 +30,31 @@ def decode_output_decoder(output, traced, nms, conf_thresh=0.5, iou_thresh=0.01)
     return boxes
 
 
-def decode_output(output, anchor_template, variances, img_width, img_height, n_classes,
-                  conf_thresh=0.5, iou_thresh=0.01):
-    #output: output of model (batch_size, nboxes, nclasses + 4)
-    #conf_thresh: minimum confidence for treat as a object
-    #iou_thresh: every boxes with IOU > iou_thresh will be filtered
-    output = output.copy()
-    batch_size = output.shape[0]
-
-    anchor_boxes = np.expand_dims(anchor_template, axis=0) #(1, nboxes, 4)
-    anchor_boxes = np.tile(anchor_boxes, (batch_size, 1, 1))
-    anchor_boxes = BoxUtils.corner2center(anchor_boxes) #(cx, cy, w, h)
-
-    output[:, :, [-4, -3, -2, -1]] *= variances
-    output[:, :, [-4, -3]] = output[:, :, [-4, -3]] * anchor_boxes[:, :, [-2, -1]] + anchor_boxes[:, :, [-4, -3]]
-    output[:, :, [-2, -1]] = np.exp(output[:, :, [-2, -1]]) * anchor_boxes[:, :, [-2, -1]]
-
-    output[:, :, -4:] = BoxUtils.center2corner(output[:, :, -4:])
-    output[:, :, -4:] *= [img_width, img_height, img_width, img_height]
-    output[:, :, :-4] = np.exp(output[:, :, :-4])
-
-    class_max = np.argmax(output[:, :, :-4], axis=-1) #(batch, nboxes)
-    class_max = np.expand_dims(class_max, axis=-1) #(batch, nboxes, 1)
-    probs_max = np.max(output[:, :, :-4], axis=-1) #batch, nboxes
-    probs_max = np.expand_dims(probs_max, axis=-1) #(batch, nboxes, 1)
-    output = np.concatenate([class_max, probs_max, output[:, :, -4:]], axis=-1) #(batch, nboxes, 6) (class_id, conf, xmin, ymin, xmax, ymax)
-    batch_output = []
-    for output_item in output:
-        boxes_filtered = []
-        #output_item: (nboxes, 6)
-        #filter background
-        output_item = output_item[output_item[:, 0] > 0]
-        output_item = output_item[output_item[:, 1] > conf_thresh]
-        for class_id in range(1, n_classes + 1):
-            #get all boxes with class_id
-            box_class_id = output_item[output_item[:, 0] == class_id]
-            #Perform nms on class id
-            nms_filtered = nms(box_class_id, iou_thresh)
-            if len(nms_filtered) > 0:
-                boxes_filtered.extend(nms_filtered)
-            batch_output.append(boxes_filtered)
-    return batch_output
-
-
-def nms(boxes, iou_thresh):
-    #boxes: (nboxes, 6) (class_id, conf, xmin, ymin, xmax, ymax)
-    boxes = boxes.copy()
-    boxes_left = []
-    while len(boxes) > 0:
-        #Find box that max conf
-        max_index = np.argmax(boxes[:, 1]) #Get box with highest conf
-        boxes_left.append(boxes[max_index])
-        boxes = np.delete(boxes, max_index, axis=0)
-        if len(boxes) < 1:
-            break
-        similarities = BoxUtils.iou_matrix(boxes[:, 2:], np.expand_dims(boxes_left[-1][2:], axis=0)) #(N, 1)
-        similarities = np.squeeze(similarities, axis=-1)
-        boxes = boxes[similarities <= iou_thresh]
-    return boxes_left
\ No newline at end of file
+def decode_output_batched(output, anchor_template, variances, img_width, img_height, n_classes,
+                          conf_thresh=0.5, iou_thresh=0.01):
+    #Decode the model output and perform nms for the whole batch as torch ops on the device of output
+    #output: output of model, tensor (batch_size, nboxes, nclasses + 4)
+    #anchor_template: tensor (nboxes, 4) anchor boxes (cx, cy, w, h), on the device of output
+    #variances: tensor (4, ) on the device of output
+    #return: list length batch_size of numpy array (K, 6) (class_id, conf, xmin, ymin, xmax, ymax)
+    batch_size = output.size(0)
+    offsets = output[:, :, -4:] * variances
+    boxes_xy = offsets[:, :, :2] * anchor_template[:, 2:] + anchor_template[:, :2]
+    boxes_wh = torch.exp(offsets[:, :, 2:]) * anchor_template[:, 2:]
+    boxes_min = boxes_xy - boxes_wh / 2.0
+    size = torch.as_tensor([img_width, img_height, img_width, img_height], dtype=output.dtype, device=output.device)
+    boxes = torch.cat([boxes_min, boxes_min + boxes_wh], dim=-1) * size #(batch, nboxes, 4) (xmin, ymin, xmax, ymax)
+
+    probs_max, class_max = torch.max(output[:, :, :-4], dim=-1) #(batch, nboxes)
+    probs_max = torch.exp(probs_max)
+    #filter background and boxes under conf_thresh
+    batch_indices, box_indices = torch.nonzero((class_max > 0) & (probs_max > conf_thresh), as_tuple=True)
+    boxes     = boxes[batch_indices, box_indices]
+    probs_max = probs_max[batch_indices, box_indices]
+    class_max = class_max[batch_indices, box_indices]
+    #Perform nms for every (batch item, class id) pair in a single call, kept boxes are sorted by decreasing conf
+    keep = torchvision.ops.batched_nms(boxes, probs_max, batch_indices * (n_classes + 1) + class_max, iou_thresh)
+    detections = torch.cat([class_max[keep, None].type(boxes.dtype), probs_max[keep, None], boxes[keep]], dim=-1)
+    detections = detections.cpu().numpy()
+    batch_indices = batch_indices[keep].cpu().numpy()
+    return [detections[batch_indices == i] for i in range(batch_size)]
\ No newline at end of file
@@ -6,9 +6,8 @@ import numpy as np
 from config import Config
 from model import SSDModel
 from VGG19BaseSSD import Vgg19BaseSSD
-from data_utils import SSDDataset, SSDDataAugmentation, Transpose, Normalization, Normalization2, collate_sample
-from torchvision import transforms
-from decode_utils import decode_output, decode_output_decoder
+from data_utils import SSDDataset, SSDDataAugmentation, collate_sample, normalize_batch, worker_init_fn
+from decode_utils import decode_output_batched, decode_output_decoder
 from box_utils import BoxUtils
 
 # device = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -35,19 +34,18 @@ class Eval:
             print("Can't load checkpoint from: ", checkpoint_path)
         else:
             print("Eval model from checkpoint: ", checkpoint_path)
-            self.model.load_state_dict(torch.load(checkpoint_path))
+            self.model.load_state_dict(torch.load(checkpoint_path, map_location=device, weights_only=True))
 
 
     def prepare_data(self):
         eval_aug = SSDDataAugmentation(target_size={'h': self.cfg.img_height, 'w': self.cfg.img_width}, train=False)  
         eval_ds  = SSDDataset(self.cfg.eval_cfg.data_dir,
                               self.cfg.eval_cfg.eval_file_path,
-                              transform=transforms.Compose([eval_aug,
-                                                            Transpose(),
-                                                            Normalization2(127.5, 127.5)
-                                                            ]))        
+                              transform=eval_aug)
         self.eval_loader  = torch.utils.data.DataLoader(dataset=eval_ds,  batch_size=self.cfg.eval_cfg.batch_size,
-                                                        collate_fn=collate_sample, shuffle=False)
+                                                        collate_fn=collate_sample, shuffle=False,
+                                                        num_workers=self.cfg.eval_cfg.num_workers, pin_memory=(device == 'cuda'),
+                                                        persistent_workers=True, prefetch_factor=2, worker_init_fn=worker_init_fn)
 
 
     def parse_config(self):
@@ -73,40 +71,45 @@ class Eval:
         font = cv2.FONT_HERSHEY_SIMPLEX   
         self.model.eval()
         x = torch.randn(1, 3, self.cfg.img_height, self.cfg.img_width).to(device)
+        anchor_boxes = BoxUtils.generate_anchor_boxes_model(self.model.get_predictor_shapes(x),
+                                                            self.cfg.scales, self.cfg.aspect_ratios)
+        anchor_boxes = BoxUtils.corner2center(np.expand_dims(anchor_boxes, axis=0))[0] #(nboxes, 4) (cx, cy, w, h)
+        anchor_boxes = torch.as_tensor(anchor_boxes, dtype=torch.float, device=device)
+        variances    = torch.as_tensor(self.cfg.variances, dtype=torch.float, device=device)
         for sample in self.eval_loader:
             batch_images, batch_labels, batch_filenames = sample['image'], sample['objs'], sample['filename']
-            batch_images = batch_images.to(device)
+            batch_images = normalize_batch(batch_images.to(device, non_blocking=True))
             total += len(batch_images)
             with torch.no_grad():
                 y_pred = self.model(batch_images)
-            y_pred = y_pred.cpu().data.numpy()
-            anchor_boxes = BoxUtils.generate_anchor_boxes_model(self.model.get_predictor_shapes(x),
-                                                                self.cfg.scales, self.cfg.aspect_ratios)
-            y_pred_decoded = decode_output(y_pred, anchor_boxes, self.cfg.variances, self.cfg.img_width,
-                                           self.cfg.img_height, self.cfg.nclasses, conf_thresh=self.cfg.eval_cfg.threshold,
-                                           iou_thresh=self.cfg.eval_cfg.iou_threshold)
+                y_pred_decoded = decode_output_batched(y_pred, anchor_boxes, variances, self.cfg.img_width,
+                                                       self.cfg.img_height, self.cfg.nclasses, conf_thresh=self.cfg.eval_cfg.threshold,
+                                                       iou_thresh=self.cfg.eval_cfg.iou_threshold)
 
             for (yp, label, filename) in zip(y_pred_decoded, batch_labels, batch_filenames):
+                stem = os.path.splitext(os.path.basename(filename))[0]
+                #Debug images are read with OpenCV like SSDDataset, same EXIF handling and supported formats
                 img = cv2.imread(os.path.join(self.cfg.eval_cfg.data_dir, filename))
                 h, w = img.shape[: 2]
                 scaley, scalex = h / self.cfg.img_height, w / self.cfg.img_width
-
-                f = open(os.path.join(self.cfg.eval_cfg.groundtruths, os.path.basename(filename).split('.')[0] + '.txt'), 'w')
-                for box in label:
-                    f.write("{} {} {} {} {}\n".format(int(box[0]), box[1], box[2], box[3], box[4]))
-                    box[1: ] *= [scalex, scaley, scalex, scaley]
-                    box = box.astype(np.int)
-                    img = cv2.rectangle(img, (box[1], box[2]), (box[3], box[4]), (0, 0, 255), 2)
-                f.close()
-
-                f = open(os.path.join(self.cfg.eval_cfg.detections, os.path.basename(filename).split('.')[0] + '.txt'), 'w')
-                for box in yp:
-                    f.write("{0} {1:.4f} {2} {3} {4} {5}\n".format(int(box[0]), box[1], int(box[2]), int(box[3]), int(box[4]), int(box[5])))
-                    box[2: ] *= [scalex, scaley, scalex, scaley]
-                    b = box[2: ].astype(np.int)
-                    img = cv2.rectangle(img, (b[0], b[1]), (b[2], b[3]), (255, 0, 0), 2)
-                    cv2.putText(img, '{:.4f}'.format(box[1]), (b[0], b[1]), font, 1, (0, 0, 255), 2)
-                f.close()
+                scale = np.array([scalex, scaley, scalex, scaley])
+                label = np.asarray(label, dtype=np.float64).reshape(-1, 5) #(M, 5) (class_id, xmin, ymin, xmax, ymax)
+                yp    = np.asarray(yp, dtype=np.float64).reshape(-1, 6)    #(K, 6) (class_id, conf, xmin, ymin, xmax, ymax)
+
+                det_boxes = yp[:, 2: ].astype(np.int64)
+                with open(os.path.join(self.cfg.eval_cfg.groundtruths, stem + '.txt'), 'w', buffering=1 << 16) as fg, \
+                     open(os.path.join(self.cfg.eval_cfg.detections, stem + '.txt'), 'w', buffering=1 << 16) as fd:
+                    fg.write("".join(["{} {} {} {} {}\n".format(int(box[0]), box[1], box[2], box[3], box[4]) for box in label]))
+                    fd.write("".join(["{0} {1:.4f} {2} {3} {4} {5}\n".format(int(box[0]), box[1], *b) for box, b in zip(yp, det_boxes)]))
+
+                #Scale all boxes back to the original image size at once, OpenCV takes int32 coordinates
+                gt_boxes  = (label[:, 1: ] * scale).astype(np.int32)
+                det_boxes = (yp[:, 2: ] * scale).astype(np.int32)
+                for (x1, y1, x2, y2) in gt_boxes.tolist():
+                    img = cv2.rectangle(img, (x1, y1), (x2, y2), (0, 0, 255), 2)
+                for (x1, y1, x2, y2), conf in zip(det_boxes.tolist(), yp[:, 1]):
+                    img = cv2.rectangle(img, (x1, y1), (x2, y2), (255, 0, 0), 2)
+                    cv2.putText(img, '{:.4f}'.format(conf), (x1, y1), font, 1, (0, 0, 255), 2)
                 cv2.imwrite(os.path.join(self.cfg.eval_cfg.debug_imgs, os.path.basename(filename)), img)
         print("Eval done!")
         cmd = "python {} -t {} --gtfolder {} --detfolder {} -gtformat xyrb -detformat xyrb --savepath {}".format(self.cfg.eval_cfg.cmd_path,
@@ -123,7 +126,7 @@ class Eval:
         x = torch.randn(1, 3, self.cfg.img_height, self.cfg.img_width).to(device)
         for sample in self.eval_loader:
             batch_images, batch_labels, batch_filenames = sample['image'], sample['objs'], sample['filename']
-            batch_images = batch_images.to(device)
+            batch_images = normalize_batch(batch_images.to(device))
             total += len(batch_images)
             with torch.no_grad():
                 y_pred = self.model(batch_images)
@@ -131,26 +134,28 @@ class Eval:
             y_pred_decoded = decode_output_decoder(y_pred, traced, nms)
 
             for (yp, label, filename) in zip(y_pred_decoded, batch_labels, batch_filenames):
+                stem = os.path.splitext(os.path.basename(filename))[0]
                 img = cv2.imread(os.path.join(self.cfg.eval_cfg.data_dir, filename))
                 h, w = img.shape[: 2]
                 scaley, scalex = h / self.cfg.img_height, w / self.cfg.img_width
-
-                f = open(os.path.join(self.cfg.eval_cfg.groundtruths, os.path.basename(filename).split('.')[0] + '.txt'), 'w')
-                for box in label:
-                    f.write("{} {} {} {} {}\n".format(int(box[0]), box[1], box[2], box[3], box[4]))
-                    box[1: ] *= [scalex, scaley, scalex, scaley]
-                    box = box.astype(np.int)
-                    img = cv2.rectangle(img, (box[1], box[2]), (box[3], box[4]), (0, 0, 255), 2)
-                f.close()
-
-                f = open(os.path.join(self.cfg.eval_cfg.detections, os.path.basename(filename).split('.')[0] + '.txt'), 'w')
-                for box in yp:
-                    f.write("{0} {1:.4f} {2} {3} {4} {5}\n".format(int(box[0]), box[1], int(box[2]), int(box[3]), int(box[4]), int(box[5])))
-                    box[2: ] *= [scalex, scaley, scalex, scaley]
-                    b = box[2: ].astype(np.int)
-                    img = cv2.rectangle(img, (b[0], b[1]), (b[2], b[3]), (255, 0, 0), 2)
-                    cv2.putText(img, '{:.4f}'.format(box[1]), (b[0], b[1]), font, 1, (0, 0, 255), 2)
-                f.close()
+                scale = np.array([scalex, scaley, scalex, scaley], dtype=np.float32)
+                label = np.asarray(label).reshape(-1, 5)                 #(M, 5) (class_id, xmin, ymin, xmax, ymax)
+                yp    = np.asarray(yp, dtype=np.float32).reshape(-1, 6) #(K, 6) (class_id, conf, xmin, ymin, xmax, ymax)
+
+                det_boxes = yp[:, 2: ].astype(np.int32)
+                with open(os.path.join(self.cfg.eval_cfg.groundtruths, stem + '.txt'), 'w') as fg, \
+                     open(os.path.join(self.cfg.eval_cfg.detections, stem + '.txt'), 'w') as fd:
+                    fg.write("".join(["{} {} {} {} {}\n".format(int(box[0]), box[1], box[2], box[3], box[4]) for box in label]))
+                    fd.write("".join(["{0} {1:.4f} {2} {3} {4} {5}\n".format(int(box[0]), box[1], *b) for box, b in zip(yp, det_boxes)]))
+
+                #Scale all boxes back to the original image size at once, OpenCV takes int32 coordinates
+                gt_boxes  = (label[:, 1: ] * scale).astype(np.int32)
+                det_boxes = (yp[:, 2: ] * scale).astype(np.int32)
+                for (x1, y1, x2, y2) in gt_boxes.tolist():
+                    img = cv2.rectangle(img, (x1, y1), (x2, y2), (0, 0, 255), 2)
+                for (x1, y1, x2, y2), conf in zip(det_boxes.tolist(), yp[:, 1]):
+                    img = cv2.rectangle(img, (x1, y1), (x2, y2), (255, 0, 0), 2)
+                    cv2.putText(img, '{:.4f}'.format(conf), (x1, y1), font, 1, (0, 0, 255), 2)
                 cv2.imwrite(os.path.join(self.cfg.eval_cfg.debug_imgs, os.path.basename(filename)), img)
         print("Eval done!")
         cmd = "python {} -t {} --gtfolder {} --detfolder {} -gtformat xyrb -detformat xyrb --savepath {}".format(self.cfg.eval_cfg.cmd_path,
@@ -1,5 +1,6 @@
 import numpy as np
 import torch
+import torchvision
 from box_utils import BoxUtils
 
 
@@ -7,58 +8,57 @@ from box_utils import BoxUtils
 class SSDLabelEncoder():
     #Encode ground truth boxes to format match output of the model
     def __init__(self, anchor_boxes_template, nclasses, img_height, img_width,
-                 pos_iou_threshold=0.5, neg_iou_threshold=0.3, variance=[0.1, 0.1, 0.2, 0.2]):
+                 pos_iou_threshold=0.5, neg_iou_threshold=0.3, variance=[0.1, 0.1, 0.2, 0.2], device='cpu'):
         #anchor_boxes_template: (nboxes, 4) anchor boxes output by the model
         #nclasses: number of positive classes
+        #device: device the matching runs on and the encoded labels are returned on
         nclasses += 1 #One for background class
         self.nclasses = nclasses
         self.img_height = img_height
         self.img_width  = img_width
         self.pos_iou_threshold = pos_iou_threshold
         self.neg_iou_threshold = neg_iou_threshold
-        self.variance = variance
-        # self.anchor_boxes_template = anchor_boxes_template
-        class_one_hot = np.zeros(shape=(len(anchor_boxes_template), nclasses)) #shape (nboxes, nclasses)
+        self.device = device
+        self.variance = torch.as_tensor(variance, dtype=torch.float, device=device)
+        self.img_size = torch.as_tensor([img_width, img_height, img_width, img_height], dtype=torch.float, device=device)
+        self.anchor_boxes = torch.as_tensor(anchor_boxes_template, dtype=torch.float, device=device) #shape (nboxes, 4)
+        anchor_centers = BoxUtils.corner2center(np.expand_dims(anchor_boxes_template, axis=0), in_place=False)[0]
+        self.anchor_centers = torch.as_tensor(anchor_centers, dtype=torch.float, device=device) #shape (nboxes, 4) (cx, cy, w, h)
+        class_one_hot = torch.zeros((len(anchor_boxes_template), nclasses), device=device) #shape (nboxes, nclasses)
         class_one_hot[:, 0] = 1 #Default all anchor boxes are background
-        output_template = np.concatenate([class_one_hot, anchor_boxes_template], axis=-1) #shape (nboxes, nclasses + 4)
-        self.output_template = np.expand_dims(output_template, axis=0) #shape (1, nboxes, nclasses + 4)
+        output_template = torch.cat([class_one_hot, self.anchor_boxes], dim=-1) #shape (nboxes, nclasses + 4)
+        self.output_template = torch.unsqueeze(output_template, dim=0) #shape (1, nboxes, nclasses + 4)
 
-        self.class_one_hots = np.eye(self.nclasses) #one hot vector for each class (nclasses, nclasses)
+        self.class_one_hots = torch.eye(self.nclasses, device=device) #one hot vector for each class (nclasses, nclasses)
 
     def bipartite_match(self, similarities_):
         #Match earch ground truth box with anchor box that max IOU
         #similarities: (M, N) similarities matrix of ground truth boxes(M) and anchor boxes(N)
         #return:(M, ) anchor box indices that matched to ground truth boxes
-        similarities = similarities_.copy()
-        matches = np.zeros(len(similarities), dtype=np.int)
-        sim_indices = range(len(similarities))
+        #Indices stay (1, ) device tensors so the loop never waits for the device
+        similarities = similarities_.clone()
+        n_anchors = similarities.size(1)
+        matches = torch.zeros(len(similarities), dtype=torch.long, device=similarities.device)
         for i in range(len(similarities)):
-            ac_indicies_max = np.argmax(similarities, axis=1)
-            ac_values_max = similarities[sim_indices, ac_indicies_max]
-            gt_indicies_max = np.argmax(ac_values_max)
-            matches[gt_indicies_max] = ac_indicies_max[gt_indicies_max]
+            #The first maximum in row major order is the same pair as max per row then max over rows
+            max_index = torch.argmax(similarities).view(1)
+            gt_index_max = torch.div(max_index, n_anchors, rounding_mode='floor')
+            ac_index_max = max_index % n_anchors
+            matches.index_copy_(0, gt_index_max, ac_index_max)
             #Remove row and column matched
-            similarities[gt_indicies_max, :] = 0
-            similarities[:, matches[gt_indicies_max]] = 0
+            similarities.index_fill_(0, gt_index_max, 0)
+            similarities.index_fill_(1, ac_index_max, 0)
         return matches
 
-    def multi_match(self, similarities_):
+    def multi_match(self, similarities):
         #Match earch anchor box(not matched) with ground truth box that IOU > self.pos_iou_threshold
         #similarities: (M, N) similarities matrix of ground truth boxes(M) and anchor boxes(N)
-        #return: 2 (L, ) ground truth box indices and anchor box indices that matched
-        similarities = similarities_.copy()
-        ac_indices = range(similarities.shape[1])
+        #return: (N, ) ground truth box index with max IOU for each anchor box and (N, ) mask of anchor boxes matched
         #Match each anchor box to ground truth box that max IOU
-        gt_indices_max = np.argmax(similarities, axis=0) #(N, )
-        #Get IOUs that matched
-        gt_values_max = similarities[gt_indices_max, ac_indices] #(N, )
-        #Create mask IOUs > pos_iou_threshold
+        gt_values_max, gt_indices_max = torch.max(similarities, dim=0) #(N, )
+        #Create mask IOUs > pos_iou_threshold, kept as a mask instead of indices to avoid a sync
         mask = gt_values_max > self.pos_iou_threshold
-        #Get anchor box index that matched to mask
-        ac_indices_thresh_matched = np.nonzero(mask)[0]
-        #Get ground truth box that matched to mask
-        gt_indices_thresh_matched = gt_indices_max[ac_indices_thresh_matched]
-        return gt_indices_thresh_matched, ac_indices_thresh_matched
+        return gt_indices_max, mask
 
     def match(self, ground_truth_boxes):
         #Assign ground truth boxes to anchor boxes
@@ -66,31 +66,35 @@ class SSDLabelEncoder():
                                 # (M number of ground truth boxes of each batch item)    (0,      , 1   , 2   , 3   , 4)
         #return: anchor boxes labeled
         batch_size = len(ground_truth_boxes)
-        output = np.tile(self.output_template, (batch_size, 1, 1)) #(batch_size, nboxes, nclasses + 4)
-        # output = self.generate_output_template(batch_size)
-        for i in range(batch_size):
-            label_i = ground_truth_boxes[i].astype(np.float) #(M, 5)
+        output = self.output_template.repeat(batch_size, 1, 1) #(batch_size, nboxes, nclasses + 4)
+        ground_truth_boxes = [np.asarray(label, dtype=np.float32).reshape(-1, 5) for label in ground_truth_boxes]
+        counts = [len(label) for label in ground_truth_boxes]
+        if sum(counts) < 1:
+            return output
+        #Copy the whole batch of ground truth boxes to the device at once, from pinned memory so the copy is async
+        labels = torch.from_numpy(np.concatenate(ground_truth_boxes, axis=0)) #(sum M, 5)
+        if labels.device.type != torch.device(self.device).type:
+            labels = labels.pin_memory().to(self.device, non_blocking=True)
+        #Normalize bboxes to range [0, 1]
+        labels[:, 1: ] /= self.img_size
+        for i, label_i in enumerate(torch.split(labels, counts)):
             if len(label_i) < 1:
                 continue
-            #Normalize bboxes to range [0, 1]
-            label_i[:, [1, 3]] /= self.img_width
-            label_i[:, [2, 4]] /= self.img_height
             #Get one hot vectors of label category
-            class_one_hot = self.class_one_hots[label_i[:, 0].astype(np.int)] #shape (M, nclasses)
-            label_one_hot = np.concatenate([class_one_hot, label_i[:, 1: ]], axis=-1) #shape (M, nclasses + 4)
+            class_one_hot = self.class_one_hots[label_i[:, 0].long()] #shape (M, nclasses)
+            label_one_hot = torch.cat([class_one_hot, label_i[:, 1: ]], dim=-1) #shape (M, nclasses + 4)
             #Caculate IOU matrix between ground truth and anchor boxes
-            similarities = BoxUtils.iou_matrix(label_i[:, 1: ], output[i, :, -4:])
+            similarities = torchvision.ops.box_iou(label_i[:, 1: ], self.anchor_boxes) #(M, nboxes)
             maches = self.bipartite_match(similarities)
-            output[i, maches, :] = label_one_hot
-            similarities[:, maches] = 0 #Erase columns that matched
+            output[i].index_copy_(0, maches, label_one_hot)
+            similarities.index_fill_(1, maches, 0) #Erase columns that matched
             #Do multi matching
-            gt_matched, ac_matched = self.multi_match(similarities)
-            output[i, ac_matched, :] = label_one_hot[gt_matched]
-            similarities[:, ac_matched] = 0
+            gt_matched, ac_mask = self.multi_match(similarities)
+            output[i] = torch.where(ac_mask[:, None], label_one_hot[gt_matched], output[i])
+            similarities.masked_fill_(ac_mask[None, :], 0)
             #Set all remain anchor boxes that IOU > neg_iou_threshold to be ignored(not treat as background)
-            max_iou_background = np.amax(similarities, axis=0)
-            ignored_anchor_boxes = np.nonzero(max_iou_background >= self.neg_iou_threshold)[0]
-            output[i, ignored_anchor_boxes, 0] = 0
+            max_iou_background = torch.max(similarities, dim=0)[0]
+            output[i, :, 0] *= max_iou_background < self.neg_iou_threshold
         return output
 
     def rescale(self, output):
@@ -99,21 +103,15 @@ class SSDLabelEncoder():
         #        (xmin, ymin, xmax, ymax)
         #        (-4,   -3,   -2,   -1)
         #Convert (xmin, ymin, xmax, ymax) to (cx, cy, w, h)
-        output[:, :, -4:] = BoxUtils.corner2center(output[:, :, -4:])
+        boxes_wh = output[:, :, -2:] - output[:, :, -4: -2]
+        boxes_xy = output[:, :, -4: -2] + boxes_wh / 2.0
 
-        batch_size = output.shape[0]
-
-        anchor_template = np.tile(self.output_template, (batch_size, 1, 1)) #(batch_size, nboxes, nclasses + 4)
-        anchor_template[:, :, -4:] = BoxUtils.corner2center(anchor_template[:, :, -4:])
-
-        output[:, :, [-4, -3]] -= anchor_template[:, :, [-4, -3]] #XY(ground truth) - XY(anchor box)
-        output[:, :, [-4, -3]] /= anchor_template[:, :, [-2, -1]] #(XY(ground truth) - XY(anchor box)) / WH(anchor box)
-
-        output[:, :, [-2, -1]] = np.log(output[:, :, [-2, -1]] / anchor_template[:, :, [-2, -1]])
-        output[:, :, -4:] /= self.variance
+        offsets_xy = (boxes_xy - self.anchor_centers[:, :2]) / self.anchor_centers[:, 2:] #(XY(ground truth) - XY(anchor box)) / WH(anchor box)
+        offsets_wh = torch.log(boxes_wh / self.anchor_centers[:, 2:])
+        output[:, :, -4:] = torch.cat([offsets_xy, offsets_wh], dim=-1) / self.variance
         return output
 
     def __call__(self, ground_truth_boxes):
+        #return: float tensor (batch, nboxes, nclasses + 4) on self.device
         output_matched = self.match(ground_truth_boxes)
-        output_rescaled = self.rescale(output_matched)
-        return torch.as_tensor(output_rescaled, dtype=torch.float)
\ No newline at end of file
+        return self.rescale(output_matched)
\ No newline at end of file
@@ -1,7 +1,6 @@
 import torch
 import torch.nn as nn
-from torchvision import transforms
-from data_utils import SSDDataset, Transpose, Normalization, Normalization2, SSDDataAugmentation, collate_sample
+from data_utils import SSDDataset, SSDDataAugmentation, SSDPhotometricAugmentation, CUDAPrefetcher, collate_sample, normalize_batch, worker_init_fn
 from ssd_loss import SSDLoss
 from label_encoder import SSDLabelEncoder
 from model import SSDModel
@@ -10,66 +9,88 @@ from config import Config
 import numpy as np
 import os
 import shutil
+import heapq
+import concurrent.futures
 from box_utils import BoxUtils
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
+#Inputs have a fixed (img_height, img_width) shape, let cudnn pick and cache the fastest conv algorithms
+torch.backends.cudnn.benchmark = True
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
 
 class Trainer():
     
     def __init__(self, cfg):
         self.cfg = cfg
-        self.prepare_data()
         self.parse_config()
+        self.prepare_data()
     
-    def build_model(self):
+    def create_model(self, pretrained=True):
+        #pretrained: load the ImageNet weights of the base network, False when a checkpoint replaces all weights
         if self.cfg.train_cfg.model_name == 'SSDModel':
-            self.model = SSDModel(self.cfg.img_width, self.cfg.img_height, self.cfg.nclasses, 
-                                  self.cfg.scales, self.cfg.aspect_ratios).to(device)
+            return SSDModel(self.cfg.img_width, self.cfg.img_height, self.cfg.nclasses, 
+                            self.cfg.scales, self.cfg.aspect_ratios)
         elif self.cfg.train_cfg.model_name == 'Vgg19BaseSSD':
-            self.model = Vgg19BaseSSD(self.cfg.img_width, self.cfg.img_height, self.cfg.nclasses, 
-                                      self.cfg.scales, self.cfg.aspect_ratios).to(device)
+            return Vgg19BaseSSD(self.cfg.img_width, self.cfg.img_height, self.cfg.nclasses, 
+                                self.cfg.scales, self.cfg.aspect_ratios, pretrained=pretrained)
         else:
             raise Exception('Model name not found!')
 
+    def build_model(self):
         checkpoint_path = os.path.join(self.cfg.train_cfg.checkpoint_dir, self.cfg.train_cfg.checkpoint_file)
         if os.path.exists(checkpoint_path):
             print("Loading checkpoint from: ", checkpoint_path)
-            self.model.load_state_dict(torch.load(checkpoint_path))
+            state_dict = torch.load(checkpoint_path, map_location=device, weights_only=True)
+            #Build the model without allocating weights, the checkpoint tensors become the parameters
+            with torch.device('meta'):
+                self.model = self.create_model(pretrained=False)
+            self.model.load_state_dict(state_dict, assign=True)
         else:
             print("Checkpoint file {} don't exists".format(checkpoint_path))
+            self.model = self.create_model().to(device)
+
+        self.model = self.model.to(memory_format=torch.channels_last)
+        #Keep the eager module to save state dicts without the '_orig_mod.' prefix
+        self._orig_model = self.model
+        #Compiling only pays off on cuda, on cpu it needs a C++ toolchain and max-autotune time for no benefit
+        if self.cfg.train_cfg.compile_model and device == 'cuda':
+            self.model = torch.compile(self.model, mode='max-autotune')
     
     
     def prepare_data(self):
+        #Workers only do the box aware augmentations (translate, scale, resize), colors are augmented on the device.
+        #The geometric ops stay in imgaug because it moves the boxes in 'objs' together with the image
         train_aug = SSDDataAugmentation(target_size={'h': self.cfg.img_height, 'w': self.cfg.img_width},
-                                        random_brightness={'low': -48, 'high': 48, 'prob': 0.5},
-                                        random_contrast={'low': 0.5, 'high': 1.8, 'prob': 0.5},
-                                        random_saturation={'low': 0.5, 'high': 1.8, 'prob': 0.5},
-                                        random_hue={'low': 0.5, 'high': 1.5, 'prob': 0.5},
-                                        channel_shuffle={'prob': 0.5},
                                         random_translate={'low': -0.2, 'high': 0.2, 'prob': 0.5},
                                         random_scale={'min': 0.7, 'max': 1.2, 'prob': 0.5},
                                         prob=0.8,
-                                        train=True)
+                                        train=True,
+                                        photometric=False)
+        self.photometric_aug = SSDPhotometricAugmentation(random_brightness={'low': 0.8, 'high': 1.2},
+                                                          random_contrast={'low': 0.5, 'high': 1.8},
+                                                          random_saturation={'low': 0.5, 'high': 1.8},
+                                                          random_hue={'low': -0.1, 'high': 0.1},
+                                                          prob=0.5)
         
         eval_aug = SSDDataAugmentation(target_size={'h': self.cfg.img_height, 'w': self.cfg.img_width},
                                        train=False)
         train_ds = SSDDataset(self.cfg.train_cfg.data_dir,
                               self.cfg.train_cfg.train_file_path,
-                              transform=transforms.Compose([train_aug,
-                                                            Transpose(),
-                                                            Normalization2(127.5, 127.5)
-                                                            ]))
+                              transform=train_aug)
         eval_ds  = SSDDataset(self.cfg.train_cfg.data_dir,
                               self.cfg.train_cfg.eval_file_path,
-                              transform=transforms.Compose([eval_aug,
-                                                            Transpose(),
-                                                            Normalization2(127.5, 127.5)
-                                                            ]))
+                              transform=eval_aug)
         
+        #Images stay uint8 (h, w, c) until they reach the device, see normalize_batch
         self.train_loader = torch.utils.data.DataLoader(dataset=train_ds, batch_size=self.cfg.train_cfg.batch_size, 
-                                                        collate_fn=collate_sample, shuffle=True)
+                                                        collate_fn=collate_sample, shuffle=True,
+                                                        num_workers=self.cfg.train_cfg.num_workers, pin_memory=(device == 'cuda'),
+                                                        persistent_workers=True, prefetch_factor=2, worker_init_fn=worker_init_fn)
         self.eval_loader  = torch.utils.data.DataLoader(dataset=eval_ds,  batch_size=self.cfg.train_cfg.batch_size,
-                                                        collate_fn=collate_sample, shuffle=False)
+                                                        collate_fn=collate_sample, shuffle=False,
+                                                        num_workers=self.cfg.train_cfg.num_workers, pin_memory=(device == 'cuda'),
+                                                        persistent_workers=True, prefetch_factor=2, worker_init_fn=worker_init_fn)
         print("Loaded dataset, train {} samples, eval {} samples".format(len(train_ds), len(eval_ds)))
 
 
@@ -77,46 +98,62 @@ class Trainer():
         self.build_model()
         self.criterion = SSDLoss(self.cfg.train_cfg.alpha, self.cfg.train_cfg.neg_pos_ratio)
         x = torch.randn(1, 3, self.cfg.img_height, self.cfg.img_width).to(device)
-        predictor_shapes = self.model.get_predictor_shapes(x)
+        predictor_shapes = self._orig_model.get_predictor_shapes(x)
         anchor_boxes = BoxUtils.generate_anchor_boxes_model(predictor_shapes, self.cfg.scales, self.cfg.aspect_ratios)
         self.label_encoder = SSDLabelEncoder(anchor_boxes,
                                              self.cfg.nclasses, self.cfg.img_height, self.cfg.img_width, 
-                                             variance=np.asarray(self.cfg.variances))
-        self.optimizer = torch.optim.Adam(self.model.parameters())
+                                             variance=np.asarray(self.cfg.variances), device=device)
+        #Fused Adam updates all parameters in one kernel, it needs the parameters on cuda
+        if device == 'cuda':
+            self.optimizer = torch.optim.Adam(self.model.parameters(), fused=True)
+        else:
+            self.optimizer = torch.optim.Adam(self.model.parameters(), foreach=True)
+        self.scaler = torch.cuda.amp.GradScaler(enabled=(device == 'cuda'))
         if  os.path.exists(self.cfg.train_cfg.checkpoint_dir) and os.path.isdir(self.cfg.train_cfg.checkpoint_dir):
             shutil.rmtree(self.cfg.train_cfg.checkpoint_dir)
         os.makedirs(self.cfg.train_cfg.checkpoint_dir, exist_ok=True)
+        self._best = [] #heap of (-eval_loss, checkpoint_path), the worst kept checkpoint is on top
+        self._save_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._save_futures  = []
 
 
     def train_on_epoch(self, epoch):
         self.model.train()
-        total_loss = 0
-        for sample in self.train_loader:
-            images = sample['image'].to(device)
-            objs   = sample['objs']
-            output = self.model(images)
-            labels = self.label_encoder(objs).to(device)
-            loss   = self.criterion(output, labels)
-            total_loss += loss.item()
+        total_loss = torch.zeros((), device=device) #Accumulated on the device to avoid a sync every step
+        accum_steps = self.cfg.train_cfg.accum_steps
+        self.optimizer.zero_grad(set_to_none=True)
+        for step, sample in enumerate(CUDAPrefetcher(self.train_loader, device)):
+            images = self.photometric_aug(sample['image'])
+            images = normalize_batch(images)
+            labels = self.label_encoder(sample['objs'])
+            with torch.autocast(device_type=device, dtype=torch.float16, enabled=(device == 'cuda')):
+                output = self.model(images)
+                loss   = self.criterion(output, labels)
+            total_loss += loss.detach()
 
-            self.optimizer.zero_grad()
-            loss.backward()
-            self.optimizer.step()
-        return total_loss / len(self.train_loader)
+            #Gradients of accum_steps micro batches are averaged before each optimizer step,
+            #the last group of the epoch can be shorter and is averaged over its real size
+            group_size = min(accum_steps, len(self.train_loader) - (step // accum_steps) * accum_steps)
+            self.scaler.scale(loss / group_size).backward()
+            if (step + 1) % accum_steps == 0 or step + 1 == len(self.train_loader):
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
+                self.optimizer.zero_grad(set_to_none=True)
+        return (total_loss / len(self.train_loader)).item()
 
 
     def evaluate_on_epoch(self, epoch):
         self.model.eval()
-        total_loss = 0
+        total_loss = torch.zeros((), device=device) #Accumulated on the device to avoid a sync every step
         with torch.no_grad():
-            for sample in self.eval_loader:
-                images = sample['image'].to(device)
-                objs   = sample['objs']
-                output = self.model(images)
-                labels = self.label_encoder(objs).to(device)
+            for sample in CUDAPrefetcher(self.eval_loader, device):
+                images = normalize_batch(sample['image'])
+                labels = self.label_encoder(sample['objs'])
+                with torch.autocast(device_type=device, dtype=torch.float16, enabled=(device == 'cuda')):
+                    output = self.model(images)
                 loss   = self.criterion(output, labels)
-                total_loss += loss.item()
-        return total_loss / len(self.eval_loader)
+                total_loss += loss.detach()
+        return (total_loss / len(self.eval_loader)).item()
 
 
     def run(self):
@@ -127,7 +164,34 @@ class Trainer():
             eval_epoch_loss  = self.evaluate_on_epoch(epoch)
             print("Epoch {}, train loss {}, eval loss {}".format(epoch, train_epoch_loss, eval_epoch_loss))
             checkpoint_file  = 'ssd_{}_{:.4f}_{:.4f}.pth'.format(epoch, train_epoch_loss, eval_epoch_loss)
-            torch.save(self.model.state_dict(), os.path.join(self.cfg.train_cfg.checkpoint_dir, checkpoint_file))
+            self.save_checkpoint(os.path.join(self.cfg.train_cfg.checkpoint_dir, checkpoint_file), eval_epoch_loss)
+        self._save_executor.shutdown(wait=True)
+        for future in self._save_futures:
+            future.result() #Raise errors from the background writes
+
+
+    def save_checkpoint(self, checkpoint_path, eval_loss):
+        #Keep only the keep_checkpoints checkpoints with the lowest eval loss
+        #Files are written and removed on a background thread so the next epoch can start
+        heapq.heappush(self._best, (-eval_loss, checkpoint_path))
+        evicted_path = None
+        if len(self._best) > self.cfg.train_cfg.keep_checkpoints:
+            evicted_path = heapq.heappop(self._best)[1]
+        if evicted_path == checkpoint_path:
+            return
+        #Snapshot the weights now, the optimizer keeps updating the parameters in place
+        state_dict = {k: v.detach().to('cpu', copy=True) for k, v in self._orig_model.state_dict().items()}
+        self._save_futures.append(self._save_executor.submit(self.write_checkpoint, state_dict, checkpoint_path, evicted_path))
+
+
+    @staticmethod
+    def write_checkpoint(state_dict, checkpoint_path, evicted_path=None):
+        #Write to a temporary file first so a checkpoint on disk is never partially written
+        tmp_path = checkpoint_path + '.tmp'
+        torch.save(state_dict, tmp_path)
+        os.replace(tmp_path, checkpoint_path)
+        if evicted_path is not None and os.path.exists(evicted_path):
+            os.remove(evicted_path)
 
 
 if __name__ == '__main__':